@@ -2,6 +2,7 @@ DDP_PORT = "8888"
 TPU_ZONE = "europe-west4-a"
 USE_TPU = False
 USE_MONGODB = True
+PRECISION = "bf16"
 
 IMAGENET_NUM_IMGS = 1281167
 IMAGENET_MEAN = [0.485, 0.456, 0.406]
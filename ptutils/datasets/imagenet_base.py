@@ -1,30 +1,144 @@
+import functools
 import os
 
+import numpy as np
 from torch.utils import data
 from torchvision import datasets
 
-__all__ = ["ImageNetBase"]
+__all__ = ["ImageNetBase", "IndexedImageFolder"]
+
+
+def _save_index(index_file, root, classes, paths, targets):
+    # Write to a temporary file first so that other processes never read a
+    # partially written index. The index is only a cache, so failing to write it
+    # (e.g. the directory is read-only) is not an error.
+    tmp_file = f"{index_file}.{os.getpid()}.tmp.npz"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+        np.savez(
+            tmp_file,
+            root=np.array(os.path.abspath(root)),
+            classes=np.array(classes),
+            paths=paths,
+            targets=targets,
+        )
+        os.replace(tmp_file, index_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_index(root, index_file=None, write_index=True):
+    """
+    Returns the classes, image paths (relative to root) and labels of an image
+    directory, from the index file if it exists. The result is cached, so that
+    building the same data set again in this process (e.g. with other transforms)
+    does not read the index or scan the directory again. As the arrays are
+    shared, they are made read only.
+    """
+    index = None
+    if (index_file is not None) and os.path.isfile(index_file):
+        with np.load(index_file) as f:
+            # The index is only used for the image directory it was built from
+            if ("root" in f) and (str(f["root"]) == os.path.abspath(root)):
+                index = {k: f[k] for k in ("classes", "paths", "targets")}
+    if index is not None:
+        classes = tuple(index["classes"].tolist())
+        paths = index["paths"]
+        targets = index["targets"]
+    else:
+        folder = datasets.ImageFolder(root)
+        classes = tuple(folder.classes)
+        # Paths are relative to root to keep the index file small
+        paths = np.array([os.path.relpath(path, root) for path, _ in folder.samples])
+        targets = np.array(folder.targets, dtype=np.int32)
+        if (index_file is not None) and write_index:
+            _save_index(
+                index_file, root=root, classes=classes, paths=paths, targets=targets
+            )
+
+    paths.flags.writeable = False
+    targets.flags.writeable = False
+    return classes, paths, targets
+
+
+class IndexedImageFolder(data.Dataset):
+    """
+    Same as torchvision.datasets.ImageFolder, except that the image paths and
+    labels are stored as numpy arrays, which can be saved to an index file so that
+    the (large) image directory only has to be scanned once.
+
+    Arguments:
+        root        : (string) image directory, organized as root/{class}/*.
+        transform   : (torchvision.Transforms) object for image transforms.
+        index_file  : (string) optional path to the index file. If it exists and
+                      was built from root, the images are read from it rather
+                      than by scanning root (otherwise, it is overwritten).
+        write_index : (boolean) whether to write the index file if it does not
+                      exist (e.g. only on one process).
+    """
+
+    def __init__(self, root, transform=None, index_file=None, write_index=True):
+        super(IndexedImageFolder, self).__init__()
+        self.root = root
+        self.transform = transform
+        self.loader = datasets.folder.default_loader
+
+        classes, self.paths, self.targets = _load_index(
+            root, index_file=index_file, write_index=write_index
+        )
+        self.classes = list(classes)
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+
+    def __getitem__(self, index):
+        sample = self.loader(os.path.join(self.root, self.paths[index]))
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample, int(self.targets[index])
+
+    def __len__(self):
+        return len(self.paths)
 
 
 class ImageNetBase(data.Dataset):
     """
-    Base class for obtaining ImageNet data set.
+    Base class for obtaining ImageNet data set. Subclasses that want the image
+    index to be cached (see get_imagenet_loaders) should take index_dir and
+    write_index (or **kwargs) and pass them to this constructor; subclasses that
+    do not are constructed without them.
 
     Arguments:
         is_train         : (boolean) if training or validation set
         imagenet_dir     : (string) base directory for ImageNet images.
         image_transforms : (torchvision.Transforms) object for image transforms. For
                            example: transforms.Compose([transforms.ToTensor()])
+        index_dir        : (string) optional directory of the cached index of the
+                           image paths and labels (see IndexedImageFolder).
+        write_index      : (boolean) whether to write the index if it is not cached.
     """
 
-    def __init__(self, is_train, imagenet_dir, image_transforms):
+    def __init__(
+        self,
+        is_train,
+        imagenet_dir,
+        image_transforms,
+        index_dir=None,
+        write_index=True,
+    ):
         # Assumes imagenet_dir organization is:
         # /PATH/TO/IMAGENET/{train, val}/{synsets}/*.JPEG
 
         super(ImageNetBase, self).__init__()
         suffix = "train" if is_train else "val"
-        self.dataset = datasets.ImageFolder(
-            os.path.join(imagenet_dir, suffix), transform=image_transforms
+        index_file = None
+        if index_dir is not None:
+            index_file = os.path.join(index_dir, f".ptutils_index_{suffix}.npz")
+        self.dataset = IndexedImageFolder(
+            os.path.join(imagenet_dir, suffix),
+            transform=image_transforms,
+            index_file=index_file,
+            write_index=write_index,
         )
 
     def __getitem__(self, index):
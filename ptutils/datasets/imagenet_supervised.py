@@ -12,13 +12,25 @@ class ImageNetSupervised(ImageNetBase):
         imagenet_dir     : (string) base directory fo ImageNet images.
         image_transforms : (torchvision.Transforms) object for image transforms. For
                            example: transforms.Compose([transforms.ToTensor()])
+        index_dir        : (string) optional directory of the cached index of the
+                           image paths and labels (see IndexedImageFolder).
+        write_index      : (boolean) whether to write the index if it is not cached.
     """
 
-    def __init__(self, is_train, imagenet_dir, image_transforms):
+    def __init__(
+        self,
+        is_train,
+        imagenet_dir,
+        image_transforms,
+        index_dir=None,
+        write_index=True,
+    ):
         super(ImageNetSupervised, self).__init__(
             is_train=is_train,
             imagenet_dir=imagenet_dir,
             image_transforms=image_transforms,
+            index_dir=index_dir,
+            write_index=write_index,
         )
 
     def __getitem__(self, index):
@@ -1,25 +1,34 @@
 import os
+import math
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from torchvision import transforms
 
 from ptutils.datasets import ImageNetBase
 import ptutils.loss_functions as lf
 from ptutils.model_training.train_utils import (
-    reduce_metric,
+    reduce_metric_root,
     AverageMeter,
     compute_accuracy,
+    cross_entropy_and_accuracy,
     check_best_accuracy,
+    copy_state_to_cpu,
     save_checkpoint,
 )
 from ptutils.model_training.trainer import Trainer
+from ptutils.model_training.trainer_transforms import split_device_transforms
 from ptutils.model_training.training_dataloader_utils import (
+    fast_collate,
     wrap_dataloaders,
     get_imagenet_loaders,
 )
 from ptutils.datasets import ImageNetSupervised
 from ptutils.models.model_transforms import MODEL_TRANSFORMS
+from ptutils.core.default_constants import PRECISION
 
 
 class SupervisedImageNetTrainer(Trainer):
@@ -43,6 +52,44 @@ class SupervisedImageNetTrainer(Trainer):
 
         self.is_best = False
 
+        # Mixed precision training on GPU: "bf16", "fp16" (with loss scaling) or
+        # "fp32". Autocast is not used on TPU.
+        self.precision = self.config.get("precision", PRECISION)
+        assert self.precision in ["bf16", "fp16", "fp32"]
+        use_scaler = (not self.use_tpu) and (self.precision == "fp16")
+        if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+            self.scaler = torch.amp.GradScaler("cuda", enabled=use_scaler)
+        else:
+            # torch.cuda.amp.GradScaler is deprecated in newer versions of PyTorch
+            self.scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+        # On GPU, checkpoints are written to disk in a background thread
+        self._ckpt_pool = ThreadPoolExecutor(max_workers=1)
+        self._ckpt_future = None
+
+    def _forward(self, data, labels):
+        """
+        Forward propagation of a minibatch, returning the loss and the top-1 and
+        top-5 accuracy of the model predictions.
+        """
+        with self._autocast():
+            if self.fused_cross_entropy:
+                predictions = self.model(data)
+                return cross_entropy_and_accuracy(output=predictions, target=labels)
+
+            loss, predictions = self.loss_func(self.model, data, labels)
+
+        acc1, acc5 = compute_accuracy(output=predictions, target=labels, topk=(1, 5))
+        return loss, acc1, acc5
+
+    def _autocast(self):
+        dtype = torch.float16 if self.precision == "fp16" else torch.bfloat16
+        return torch.autocast(
+            device_type="cuda",
+            dtype=dtype,
+            enabled=(not self.use_tpu) and (self.precision != "fp32"),
+        )
+
     def initialize_loss_function(self):
         assert hasattr(self, "config")
         self.check_key("loss_params")
@@ -51,22 +98,41 @@ class SupervisedImageNetTrainer(Trainer):
 
         loss_class = self.config["loss_params"]["class"]
         loss_func = lf.__dict__[loss_class]()
+
+        # For the standard cross-entropy loss, the loss and accuracy are computed
+        # together from the model predictions, see _forward()
+        self.fused_cross_entropy = (type(loss_func) is lf.CrossEntropyLoss) and (
+            loss_func.reduction == "mean"
+        )
         return loss_func
 
     def initialize_optimizer(self):
         assert hasattr(self, "config")
         assert hasattr(self, "model")
+        assert hasattr(self, "use_tpu")
         self.check_key("optimizer_params")
 
         assert "initial_lr" in self.config["optimizer_params"].keys()
         assert "momentum" in self.config["optimizer_params"].keys()
         assert "weight_decay" in self.config["optimizer_params"].keys()
 
+        optim_kwargs = dict()
+        if not self.use_tpu:
+            # Update all the parameters with a few (multi-tensor) kernels rather than
+            # one kernel per parameter tensor. The fused implementation is preferred
+            # if this PyTorch version supports it (fused and foreach are exclusive).
+            sgd_args = inspect.signature(torch.optim.SGD).parameters
+            if "fused" in sgd_args:
+                optim_kwargs["fused"] = True
+            elif "foreach" in sgd_args:
+                optim_kwargs["foreach"] = True
+
         optim = torch.optim.SGD(
             self.model.parameters(),
             lr=self.config["optimizer_params"]["initial_lr"],
             momentum=self.config["optimizer_params"]["momentum"],
             weight_decay=self.config["optimizer_params"]["weight_decay"],
+            **optim_kwargs,
         )
         return optim
 
@@ -84,17 +150,55 @@ class SupervisedImageNetTrainer(Trainer):
         params = dict()
         params["dataset_class"] = ImageNetSupervised
         params["image_dir"] = self.config.get("image_dir", "")
+        # Directory of the cached index of the image paths and labels, which by
+        # default is the save directory of the run rather than the (shared)
+        # image directory. None disables the index.
+        params["index_dir"] = self.config.get("dataset_index_dir", self.save_dir)
         params["train_batch_size"] = self.config["optimizer_params"]["train_batch_size"]
         params["val_batch_size"] = self.config["optimizer_params"]["val_batch_size"]
         params["num_workers"] = self.config["dataloader_workers"]
+        if "dataloader_prefetch_factor" in self.config.keys():
+            params["prefetch_factor"] = self.config["dataloader_prefetch_factor"]
+        if "dataloader_pin_memory" in self.config.keys():
+            params["pin_memory"] = self.config["dataloader_pin_memory"]
+        if "dataloader_persistent_workers" in self.config.keys():
+            params["persistent_workers"] = self.config["dataloader_persistent_workers"]
+        for key in ["tpu_loader_prefetch", "tpu_device_prefetch"]:
+            if key in self.config.keys():
+                params[key] = self.config[key]
+        if "dataloader_pin_worker_cpus" in self.config.keys():
+            params["pin_worker_cpus"] = self.config["dataloader_pin_worker_cpus"]
+
+        # "torch" or "dali", where DALI decodes and augments the images on the GPU
+        params["loader_backend"] = self.config.get("dataloader_backend", "torch")
 
         my_transforms = dict()
-        my_transforms["train"] = transforms.Compose(
-            MODEL_TRANSFORMS[self.model_name]["train"]
-        )
-        my_transforms["val"] = transforms.Compose(
-            MODEL_TRANSFORMS[self.model_name]["val"]
-        )
+        device_transforms = None
+        if params["loader_backend"] == "dali":
+            # DALI seeds its own random augmentations and shuffling (per rank)
+            params["seed"] = self.config["seed"]
+            my_transforms["train"] = transforms.Compose(
+                MODEL_TRANSFORMS[self.model_name]["train"]
+            )
+            my_transforms["val"] = transforms.Compose(
+                MODEL_TRANSFORMS[self.model_name]["val"]
+            )
+        else:
+            # Images are collated as uint8 tensors, which are a quarter of the size
+            # of float images, and are flipped, converted to float and normalized
+            # once on the GPU/TPU (see wrap_dataloaders)
+            params["collate_fn"] = fast_collate
+            # Optional directory where the decoded and cropped (uint8) validation
+            # images are cached
+            params["val_mmap_dir"] = self.config.get("val_mmap_dir", None)
+            # or the size (in GB) of the shared memory cache of these images
+            params["shm_cache_gb"] = self.config.get("val_shm_cache_gb", 0)
+            device_transforms = dict()
+            for split in ["train", "val"]:
+                cpu_transforms, device_transforms[split] = split_device_transforms(
+                    MODEL_TRANSFORMS[self.model_name][split]
+                )
+                my_transforms[split] = transforms.Compose(cpu_transforms)
 
         train_loader, val_loader = wrap_dataloaders(
             dataloader_func=get_imagenet_loaders,
@@ -103,6 +207,8 @@ class SupervisedImageNetTrainer(Trainer):
             device=self.device,
             rank=self.rank,
             world_size=self.world_size,
+            device_transforms=device_transforms,
+            channels_last=self.channels_last,
         )
         return train_loader, val_loader
 
@@ -129,72 +235,93 @@ class SupervisedImageNetTrainer(Trainer):
 
             self.print_fn(f"Updating learning rate to: {new_lr}")
 
-    def train_one_epoch(self):
-        assert hasattr(self, "train_loader")
-        assert hasattr(self, "use_tpu")
-        assert hasattr(self, "model")
-        assert hasattr(self, "loss_func")
-        assert hasattr(self, "device")
+    def _reduce_step_metrics(self, metric_buf, epoch_buf):
+        """
+        Adds the metrics accumulated on each GPU since the last log step to the
+        epoch totals, reduces them onto rank 0 (which prints them) with a single
+        reduce, and resets the buffer. The metrics stay on the GPU, so this does
+        not synchronize with the host.
+
+        Inputs:
+            metric_buf : (torch.Tensor) (4,); running sums of the loss, top-1 and
+                         top-5 accuracy (each weighted by the number of examples),
+                         followed by the number of examples
+            epoch_buf  : (torch.Tensor) (4,); same as metric_buf, over the epoch
+
+        Outputs:
+            averages   : (torch.Tensor) (3,); average loss, top-1 and top-5 accuracy
+                         across GPUs since the last log step, only valid on rank 0
+        """
+        epoch_buf += metric_buf
+        reduce_metric_root(metric_buf, self.world_size)
+        averages = metric_buf[:3] / metric_buf[3]
+        metric_buf.zero_()
+        return averages
+
+    def _reduce_epoch_metrics(self, epoch_buf, meters):
+        """
+        Sums the metrics accumulated on each GPU over the epoch with a single
+        all-reduce, so that every GPU has the epoch averages, and updates the
+        average meters for the loss, top-1 and top-5 accuracy with them.
+        """
+        dist.all_reduce(epoch_buf)
+        num_examples = epoch_buf[3]
+        for meter, total in zip(meters, epoch_buf[:3]):
+            meter.update_tensor(total / num_examples, num_examples)
 
+    def train_one_epoch(self):
         losses = AverageMeter("Loss", ":.4e")
         top1 = AverageMeter("Acc@1", ":6.2f")
         top5 = AverageMeter("Acc@5", ":6.2f")
         num_steps = len(self.train_loader)
         num_batches = len(self.train_loader)
-        batch_size = (
-            self.config["optimizer_params"]["train_batch_size"] // self.world_size
+        # Per process batch size, which is rounded up (see wrap_dataloaders)
+        batch_size = math.ceil(
+            self.config["optimizer_params"]["train_batch_size"] / self.world_size
         )
+        log_freq = self.config.get("log_freq", 10)
 
         if self.use_tpu:
             import torch_xla.core.xla_model as xm
 
             tracker = xm.RateTracker()
 
+        # The loader already assigns each minibatch to the device (see
+        # wrap_dataloaders)
+        if not self.use_tpu:
+            # Running sums of loss, top-1, top-5 and number of examples since the
+            # last log step, and over the epoch
+            metric_buf = torch.zeros(4, device=self.device)
+            epoch_buf = torch.zeros(4, device=self.device)
+
         self.set_model_to_train()
         for i, (data, labels) in enumerate(self.train_loader):
-            curr_step = self.current_epoch * num_batches + i
-            if not self.use_tpu:
-                # For TPU, we have already assigned it to the device
-                # use non_blocking: https://discuss.pytorch.org/t/should-we-set-non-blocking-to-true/38234/5
-                data = data.to(self.device, non_blocking=True)
-                labels = labels.to(self.device, non_blocking=True)
-
             # Zero gradients
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
 
-            # Forward propagation
-            loss, predictions = self.loss_func(self.model, data, labels)
+            # Forward propagation and metrics
+            loss, acc1, acc5 = self._forward(data, labels)
 
-            # Backward propagation
-            loss.backward()
+            # Backward propagation (the loss is only scaled for fp16)
+            self.scaler.scale(loss).backward()
 
             # Update parameters
             if self.use_tpu:
                 xm.optimizer_step(self.optimizer)
                 tracker.add(batch_size)
             else:
-                self.optimizer.step()
-
-            # Metrics
-            acc1, acc5 = compute_accuracy(
-                output=predictions, target=labels, topk=(1, 5)
-            )
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
             if self.use_tpu:
-                rep_loss = loss.item()
-                rep_acc1 = acc1.item()
-                rep_acc5 = acc5.item()
-            else:
-                rep_loss = reduce_metric(loss, self.world_size).item()
-                rep_acc1 = reduce_metric(acc1, self.world_size).item()
-                rep_acc5 = reduce_metric(acc5, self.world_size).item()
-
-            losses.update(rep_loss, data.size(0))
-            top1.update(rep_acc1, data.size(0))
-            top5.update(rep_acc5, data.size(0))
-
-            if self.use_tpu:
-                if curr_step % 10 == 0:
+                losses.update_tensor(loss, data.size(0))
+                top1.update_tensor(acc1, data.size(0))
+                top5.update_tensor(acc5, data.size(0))
+
+                # Only build the log message (which synchronizes with the TPU to
+                # get the loss) every log_freq steps
+                curr_step = self.current_epoch * num_batches + i
+                if curr_step % log_freq == 0:
                     examples_seen = i * batch_size * self.world_size
                     examples_seen += (self.rank + 1) * batch_size
                     per_worker_header = (
@@ -210,21 +337,35 @@ class SupervisedImageNetTrainer(Trainer):
                         f"\tLoss: {loss.item():.6f}"
                         f"\tStep: {curr_step}"
                     )
-            elif self.rank == 0:
-                print_str = (
-                    f"[Epoch {self.current_epoch}; Step {i+1}/{num_steps}] "
-                    f"Train Loss {rep_loss:.6f}; Train Accuracy: {rep_acc1:.6f}"
-                )
-                self.print_fn(f"{print_str}")
+            else:
+                # Accumulate metrics on the GPU, and only reduce them onto the GPU
+                # that prints them every log_freq steps
+                batch_metrics = torch.stack([loss.detach(), acc1, acc5])
+                metric_buf[:3] += batch_metrics * data.size(0)
+                metric_buf[3] += data.size(0)
+                if ((i + 1) % log_freq == 0) or (i + 1 == num_steps):
+                    averages = self._reduce_step_metrics(metric_buf, epoch_buf)
+                    if self.rank == 0:
+                        # Only synchronize with the host on the GPU that prints
+                        rep_loss, rep_acc1, _ = averages.tolist()
+                        print_str = (
+                            f"[Epoch {self.current_epoch}; Step {i+1}/{num_steps}] "
+                            f"Train Loss {rep_loss:.6f}; Train Accuracy: {rep_acc1:.6f}"
+                        )
+                        self.print_fn(f"{print_str}")
 
-        average_loss = losses.avg
-        average_top1 = top1.avg
-        average_top5 = top5.avg
+        if not self.use_tpu:
+            self._reduce_epoch_metrics(epoch_buf, meters=[losses, top1, top5])
+
+        epoch_metrics = torch.stack([losses.avg, top1.avg, top5.avg])
         if self.use_tpu:
-            # average across TPU replicas
-            average_loss = xm.mesh_reduce("train_average_loss", average_loss, np.mean)
-            average_top1 = xm.mesh_reduce("train_average_top1", average_top1, np.mean)
-            average_top5 = xm.mesh_reduce("train_average_top5", average_top5, np.mean)
+            # average across TPU replicas with a single all-reduce
+            epoch_metrics = xm.all_reduce(
+                xm.REDUCE_SUM, epoch_metrics, scale=1.0 / self.world_size
+            )
+
+        # Single device to host synchronization for the epoch averages
+        average_loss, average_top1, average_top5 = epoch_metrics.tolist()
 
         # Print train results over entire dataset
         msg_str = "[Epoch {}] Train Loss: {:.6f}; Train Accuracy: {:.6f}".format(
@@ -242,12 +383,6 @@ class SupervisedImageNetTrainer(Trainer):
         self.results["accs_top5"]["train"].append(average_top5)
 
     def validate(self):
-        assert hasattr(self, "val_loader")
-        assert hasattr(self, "use_tpu")
-        assert hasattr(self, "model")
-        assert hasattr(self, "loss_func")
-        assert hasattr(self, "device")
-
         if (self.current_epoch % self.config["save_freq"] == 0) or (
             self.current_epoch + 1 == self.config["num_epochs"]
         ):
@@ -255,53 +390,50 @@ class SupervisedImageNetTrainer(Trainer):
             top1 = AverageMeter("Acc@1", ":6.2f")
             top5 = AverageMeter("Acc@5", ":6.2f")
             num_steps = len(self.val_loader)
+            log_freq = self.config.get("log_freq", 10)
+
+            if not self.use_tpu:
+                # Running sums of loss, top-1, top-5 and number of examples since
+                # the last log step, and over the epoch
+                metric_buf = torch.zeros(4, device=self.device)
+                epoch_buf = torch.zeros(4, device=self.device)
 
             self.set_model_to_eval()
             with torch.no_grad():
                 for i, (data, labels) in enumerate(self.val_loader):
-                    if not self.use_tpu:
-                        # For TPU, we have already assigned it to the device
-                        # use non_blocking: https://discuss.pytorch.org/t/should-we-set-non-blocking-to-true/38234/5
-                        data = data.to(self.device, non_blocking=True)
-                        labels = labels.to(self.device, non_blocking=True)
-
-                    loss, predictions = self.loss_func(self.model, data, labels)
-
-                    # Metrics
-                    acc1, acc5 = compute_accuracy(
-                        output=predictions, target=labels, topk=(1, 5)
-                    )
+                    loss, acc1, acc5 = self._forward(data, labels)
 
                     if self.use_tpu:
-                        rep_loss = loss.item()
-                        rep_acc1 = acc1.item()
-                        rep_acc5 = acc5.item()
+                        losses.update_tensor(loss, data.size(0))
+                        top1.update_tensor(acc1, data.size(0))
+                        top5.update_tensor(acc5, data.size(0))
                     else:
-                        rep_loss = reduce_metric(loss, self.world_size).item()
-                        rep_acc1 = reduce_metric(acc1, self.world_size).item()
-                        rep_acc5 = reduce_metric(acc5, self.world_size).item()
+                        batch_metrics = torch.stack([loss, acc1, acc5])
+                        metric_buf[:3] += batch_metrics * data.size(0)
+                        metric_buf[3] += data.size(0)
+                        if ((i + 1) % log_freq == 0) or (i + 1 == num_steps):
+                            averages = self._reduce_step_metrics(metric_buf, epoch_buf)
+                            if self.rank == 0:
+                                rep_loss, rep_acc1, _ = averages.tolist()
+                                print_str = (
+                                    f"[Epoch {self.current_epoch}; Step {i+1}/{num_steps}] "
+                                    f"Val Loss {rep_loss:.6f}; Val Accuracy: {rep_acc1:.6f}"
+                                )
+                                self.print_fn(f"{print_str}")
 
-                    losses.update(rep_loss, data.size(0))
-                    top1.update(rep_acc1, data.size(0))
-                    top5.update(rep_acc5, data.size(0))
-
-                    if (not self.use_tpu) and (self.rank == 0):
-                        print_str = (
-                            f"[Epoch {self.current_epoch}; Step {i+1}/{num_steps}] "
-                            f"Val Loss {rep_loss:.6f}; Val Accuracy: {rep_acc1:.6f}"
-                        )
-                        self.print_fn(f"{print_str}")
+            if not self.use_tpu:
+                self._reduce_epoch_metrics(epoch_buf, meters=[losses, top1, top5])
 
-            average_loss = losses.avg
-            average_top1 = top1.avg
-            average_top5 = top5.avg
+            epoch_metrics = torch.stack([losses.avg, top1.avg, top5.avg])
             if self.use_tpu:
-                # Average across TPU replicas
+                # Average across TPU replicas with a single all-reduce
                 import torch_xla.core.xla_model as xm
 
-                average_loss = xm.mesh_reduce("val_average_loss", average_loss, np.mean)
-                average_top1 = xm.mesh_reduce("val_average_top1", average_top1, np.mean)
-                average_top5 = xm.mesh_reduce("val_average_top5", average_top5, np.mean)
+                epoch_metrics = xm.all_reduce(
+                    xm.REDUCE_SUM, epoch_metrics, scale=1.0 / self.world_size
+                )
+
+            average_loss, average_top1, average_top5 = epoch_metrics.tolist()
 
             # Print val results over entire dataset
             msg_str = "[Epoch {}] Val Loss: {:.6f}; Val Accuracy: {:.6f}".format(
@@ -324,19 +456,10 @@ class SupervisedImageNetTrainer(Trainer):
             )
 
     def save_checkpoint(self):
-        assert hasattr(self, "current_epoch")
-        assert hasattr(self, "model")
-        assert hasattr(self, "optimizer")
-        assert hasattr(self, "results")
-        assert hasattr(self, "save_dir")
-        assert hasattr(self, "use_tpu")
-        assert hasattr(self, "config")
         assert "save_freq" in self.config.keys()
 
         curr_state = {
             "epoch": self.current_epoch,
-            "state_dict": self.model.state_dict(),
-            "optimizer": self.optimizer.state_dict(),
             "results": self.results,
             "curr_best_acc": self.best_acc,
         }
@@ -352,15 +475,49 @@ class SupervisedImageNetTrainer(Trainer):
                 curr_state=curr_state, save_keys=["epoch", "results", "curr_best_acc"]
             )
 
-        # we always save the intermediate checkpoints each epoch
-        save_checkpoint(
-            state=curr_state,
-            save_dir=self.save_dir,
-            is_best=self.is_best,
-            save_epoch=save_epoch,
-            rank=self.rank,
-            tpu=self.use_tpu,
-        )
+        # By default, we always save the intermediate checkpoints each epoch.
+        # Otherwise, we only save them when a new checkpoint file is created, and
+        # skip collecting the model and optimizer state dicts altogether.
+        is_best = self.is_best
+        # is_best only refers to the last validation, so reset it once used
+        self.is_best = False
+        if (
+            (not self.config.get("save_every_epoch", True))
+            and (save_epoch is None)
+            and (not is_best)
+        ):
+            return
+
+        # Save the state dict of the uncompiled model, so that its keys do not
+        # depend on whether torch.compile was used
+        model = getattr(self.model, "_orig_mod", self.model)
+        curr_state["state_dict"] = model.state_dict()
+        curr_state["optimizer"] = self.optimizer.state_dict()
+
+        save_kwargs = {
+            "save_dir": self.save_dir,
+            "is_best": is_best,
+            "save_epoch": save_epoch,
+            "rank": self.rank,
+            "tpu": self.use_tpu,
+        }
+        if self.use_tpu:
+            # xm.save() needs all the TPU cores to participate, so save synchronously
+            save_checkpoint(state=curr_state, **save_kwargs)
+        elif self.rank == 0:
+            # Only the first GPU writes checkpoints. Snapshot the state to the cpu
+            # and write it to disk while the next epoch is running. We wait for
+            # the previous checkpoint first, so that writes do not pile up.
+            self.wait_for_checkpoint()
+            self._ckpt_future = self._ckpt_pool.submit(
+                save_checkpoint, state=copy_state_to_cpu(curr_state), **save_kwargs
+            )
+
+    def wait_for_checkpoint(self):
+        if self._ckpt_future is not None:
+            # Also raises any exception that occurred while saving
+            self._ckpt_future.result()
+            self._ckpt_future = None
 
     def load_checkpoint(self):
         assert hasattr(self, "model")
@@ -404,8 +561,9 @@ class SupervisedImageNetTrainer(Trainer):
         assert not hasattr(self, "results")
         self.results = cpt["results"]
 
-        # Load model state dict
-        self.model.load_state_dict(cpt["state_dict"])
+        # Load model state dict (into the uncompiled model, see save_checkpoint())
+        model = getattr(self.model, "_orig_mod", self.model)
+        model.load_state_dict(cpt["state_dict"])
 
         # Load optimizer state dict
         self.optimizer.load_state_dict(cpt["optimizer"])
@@ -1,14 +1,18 @@
 import os
+import copy
 import json
 import shutil
 import random
+import warnings
 
 import numpy as np
 import regex as re
+from typing import Tuple
 
 import torch
 import torchvision.models
 import torch.optim as optim
+import torch.nn.functional as F
 import torch.distributed as dist
 
 from math import cos, pi
@@ -64,6 +68,16 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def update_tensor(self, val, n=1):
+        """
+        Same as update(), but val is a (scalar) tensor that is kept on its device,
+        so that no device to host synchronization happens until avg is read.
+        """
+        self.val = val.detach()
+        self.sum = self.sum + self.val * n
+        self.count = self.count + n
+        self.avg = self.sum / self.count
+
     def __str__(self):
         fmtstr = "{name} {val" + self.fmt + "} ({avg" + self.fmt + "})"
         return fmtstr.format(**self.__dict__)
@@ -75,22 +89,101 @@ class AverageMeter(object):
 
 
 def compute_accuracy(output, target, topk=(1,)):
-    """Adapted from PyTorch tutorial."""
+    """
+    Adapted from PyTorch tutorial. Checking whether the target is among the top-k
+    predictions does not depend on their order, so the top-k predictions are only
+    sorted if they are needed for several k > 1. The top-1 prediction is given
+    by the argmax.
+    """
     with torch.no_grad():
-        maxk = max(topk)
         batch_size = target.size(0)
+        target = target.view(-1, 1)
 
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
+        ks = sorted(set([k for k in topk if k > 1]))
+        if len(ks) > 0:
+            _, pred = output.topk(ks[-1], 1, True, len(ks) > 1)
+            correct = pred.eq(target)
 
         res = []
         for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0)
+            if k == 1:
+                correct_k = output.argmax(1, keepdim=True).eq(target)
+            else:
+                correct_k = correct[:, :k]
+            correct_k = correct_k.any(1).float().sum(0)
             res.append(correct_k.mul_(1.0 / batch_size))
         return res
 
 
+def cross_entropy_and_accuracy(output, target):
+    """
+    Computes the (mean) cross-entropy loss together with the top-1 and top-5
+    accuracy from a single log-softmax of the logits, rather than reading the
+    logits once for the loss and again for the accuracy. As in compute_accuracy(),
+    the top-5 predictions are not sorted and the top-1 prediction is the argmax.
+
+    Inputs:
+        output : (torch.Tensor) (N, K); logits for K classes
+        target : (torch.LongTensor) (N,); labels
+
+    Outputs:
+        loss   : (torch.Tensor) scalar; cross-entropy loss
+        acc1   : (torch.Tensor) scalar; top-1 accuracy
+        acc5   : (torch.Tensor) scalar; top-5 accuracy
+    """
+    global _ce_and_topk_fn, _ce_and_topk_validated
+    if _ce_and_topk_fn is None:
+        _ce_and_topk_fn = _fuse_ce_and_topk()
+    if _ce_and_topk_validated:
+        return _ce_and_topk_fn(output, target)
+
+    # Until the compiled function has run once, an error may come from compiling
+    # it (e.g. no compiler is available for torch.compile), in which case the eager
+    # function is used instead. Errors of the eager function itself (e.g. invalid
+    # labels) are raised as is, and afterwards all errors are raised as is.
+    try:
+        result = _ce_and_topk_fn(output, target)
+    except Exception as e:
+        if _ce_and_topk_fn is _ce_and_topk:
+            raise
+        result = _ce_and_topk(output, target)
+        warnings.warn(f"Falling back to the eager cross-entropy and accuracy: {e}")
+        _ce_and_topk_fn = _ce_and_topk
+    _ce_and_topk_validated = True
+    return result
+
+
+def _ce_and_topk(
+    logits: torch.Tensor, target: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Compiled (see _fuse_ce_and_topk) so that the pointwise ops can be fused. The
+    # logits are cast to float explicitly, since autocast is not guaranteed to apply
+    # to scripted functions.
+    log_probs = F.log_softmax(logits.float(), dim=1)
+    loss = F.nll_loss(log_probs, target)
+    # The top-k indices (and hence the accuracies) are not differentiable
+    target = target.view(-1, 1)
+    _, pred = log_probs.topk(5, 1, True, False)
+    acc1 = log_probs.argmax(1, keepdim=True).eq(target).float().mean()
+    acc5 = pred.eq(target).any(1).float().mean()
+    return loss, acc1, acc5
+
+
+# Compiled lazily on first use rather than at import, since torch.jit.script is
+# deprecated in newer versions of PyTorch and warns when it is called
+_ce_and_topk_fn = None
+_ce_and_topk_validated = False
+
+
+def _fuse_ce_and_topk():
+    if hasattr(torch, "compile"):
+        return torch.compile(_ce_and_topk, dynamic=True)
+    try:
+        return torch.jit.script(_ce_and_topk)
+    except Exception:
+        return _ce_and_topk
+
+
 def reduce_metric(metric, world_size):
     """
     Reduces a metric across all processes.
@@ -105,6 +198,25 @@ def reduce_metric(metric, world_size):
         return avg_metric
 
 
+def reduce_metric_root(metric, world_size, dst=0):
+    """
+    Reduces a metric across all processes onto a single process. This requires
+    less communication than reduce_metric() when only one process needs the result,
+    e.g. to print it.
+
+    Inputs:
+        metric     : (torch.Tensor) can be loss, top-1 accuracy, etc. It is reduced
+                     in place and its value is undefined on the other processes.
+        world_size : (int) number of processes (i.e., GPUs)
+        dst        : (int) rank of the process that receives the average metric
+    """
+    with torch.no_grad():
+        dist.reduce(metric, dst=dst)
+        if dist.get_rank() == dst:
+            metric /= world_size
+        return metric
+
+
 def get_save_checkpoint_path(save_dir, is_best=False, save_epoch=None):
     fname = LATEST_CKPT_NAME
 
@@ -118,6 +230,31 @@ def get_save_checkpoint_path(save_dir, is_best=False, save_epoch=None):
     return fname
 
 
+def copy_state_to_cpu(state):
+    """
+    Recursively copies a (nested) checkpoint state, moving all its tensors to the
+    cpu, so that the copy can be saved while training continues to modify the
+    original state (e.g. in a background thread).
+
+    Inputs:
+        state : (dict) e.g. containing model and optimizer state dicts
+
+    Outputs:
+        state : (dict) copy of the state with all tensors on the cpu
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    elif isinstance(state, dict):
+        state_copy = type(state)((k, copy_state_to_cpu(v)) for k, v in state.items())
+        # Module state dicts store version information in this attribute
+        if hasattr(state, "_metadata"):
+            state_copy._metadata = copy.deepcopy(state._metadata)
+        return state_copy
+    elif isinstance(state, (list, tuple)):
+        return type(state)(copy_state_to_cpu(v) for v in state)
+    return copy.deepcopy(state)
+
+
 def save_checkpoint(state, save_dir, is_best, save_epoch, rank=0, tpu=False):
     fname = get_save_checkpoint_path(save_dir=save_dir)
     if tpu:
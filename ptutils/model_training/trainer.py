@@ -1,4 +1,5 @@
 import os
+import inspect
 import shutil
 import torch
 import torch.nn as nn
@@ -78,6 +79,27 @@ class Trainer:
                 # Remove the file locally after loading from gs bucket
                 os.remove(self.config["resume_checkpoint"])
 
+        self._validate_state()
+
+    def _validate_state(self):
+        """
+        Checks once, at the end of __init__, that the attributes used by the
+        per-epoch methods have been set, rather than on every call to them.
+        """
+        for attr in [
+            "config",
+            "save_dir",
+            "device",
+            "use_tpu",
+            "model",
+            "train_loader",
+            "val_loader",
+            "loss_func",
+            "optimizer",
+            "current_epoch",
+        ]:
+            assert hasattr(self, attr), f"{attr} was not set in __init__"
+
     def check_key(self, key):
         assert hasattr(self, "config")
         assert key in self.config.keys(), f"{key} undefined in config file."
@@ -197,10 +219,49 @@ class Trainer:
 
         model = model.to(self.device)
 
+        # Channels last (NHWC) memory format enables the faster cuDNN convolution
+        # kernels on tensor cores. It only changes the layout, and is GPU only.
+        self.channels_last = (not self.use_tpu) and self.config.get(
+            "channels_last", True
+        )
+
         # gpu training
         if not self.use_tpu:
             assert hasattr(self, "gpu_ids")
-            model = nn.parallel.DistributedDataParallel(model, device_ids=self.gpu_ids)
+            if self.channels_last:
+                model = model.to(memory_format=torch.channels_last)
+
+            # Gradients are views into the DDP communication buckets, which saves a
+            # copy of the gradients each step, and larger buckets mean fewer (but
+            # larger) all-reduces. A static graph (i.e. the same parameters are used
+            # every iteration) allows DDP to further optimize the bucketing.
+            static_graph = self.config.get("ddp_static_graph", True)
+            ddp_kwargs = dict()
+            # The static_graph argument only exists from PyTorch 1.11 onwards
+            ddp_params = inspect.signature(
+                nn.parallel.DistributedDataParallel
+            ).parameters
+            if "static_graph" in ddp_params:
+                ddp_kwargs["static_graph"] = static_graph
+            model = nn.parallel.DistributedDataParallel(
+                model,
+                device_ids=self.gpu_ids,
+                gradient_as_bucket_view=True,
+                bucket_cap_mb=self.config.get("ddp_bucket_mb", 50),
+                **ddp_kwargs,
+            )
+            if static_graph and ("static_graph" not in ddp_params):
+                model._set_static_graph()
+
+            # Compile the model (requires PyTorch >= 2.0) so that pointwise ops are
+            # fused and kernel launch overhead is reduced. Note that custom
+            # autograd.Functions in the model may not be fused in the backward pass.
+            # The compiled model shares its parameters with the original one, which
+            # is accessible through model._orig_mod (e.g. for its state dict).
+            if self.config.get("compile_model", False):
+                model = torch.compile(
+                    model, mode=self.config.get("compile_mode", "reduce-overhead")
+                )
 
         model_name = self.config["model"]
 
@@ -210,7 +271,6 @@ class Trainer:
         """
         Main entry point for training a model.
         """
-        assert hasattr(self, "train_loader")
         self.check_key("save_freq")
         self.check_key("num_epochs")
 
@@ -218,25 +278,26 @@ class Trainer:
             self.current_epoch = i
             # See warning in:
             # https://pytorch.org/docs/stable/data.html#torch.utils.data.distributed.DistributedSampler
-            if self.use_tpu:
-                self.train_loader._loader.sampler.set_epoch(i)
+            loader = self.train_loader._loader if self.use_tpu else self.train_loader
+            if hasattr(loader, "set_epoch"):
+                loader.set_epoch(i)
             else:
-                self.train_loader.sampler.set_epoch(i)
+                # e.g. a DataLoader that was not built by _acquire_dataloader
+                loader.sampler.set_epoch(i)
 
             self.adjust_learning_rate()
             self.train_one_epoch()
             self.validate()
             self.save_checkpoint()
 
+        self.wait_for_checkpoint()
         self.close_db()
 
     def set_model_to_train(self):
         self.model.train()
-        assert self.model.training
 
     def set_model_to_eval(self):
         self.model.eval()
-        assert not self.model.training
 
     def close_db(self):
         if (self.rank == 0) and (self.database is not None):
@@ -273,3 +334,10 @@ class Trainer:
 
     def load_checkpoint(self):
         raise NotImplementedError
+
+    def wait_for_checkpoint(self):
+        """
+        This function should block until any checkpoint that is being saved
+        asynchronously has been written.
+        """
+        pass
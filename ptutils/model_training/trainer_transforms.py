@@ -3,6 +3,8 @@ Contains information on image transformations used by different trainers
 (e.g. supervised, self-supervised, etc) during training and validation.
 """
 import numpy as np
+import torch
+import torch.nn as nn
 from torchvision import transforms
 from ptutils.core.default_constants import IMAGENET_MEAN, IMAGENET_STD
 
@@ -15,6 +17,94 @@ def compose_ifnot(dataloader_transforms):
         return dataloader_transforms
 
 
+class BatchRandomHorizontalFlip(nn.Module):
+    """
+    Same as transforms.RandomHorizontalFlip, but applied independently to each
+    image of a (N, C, H, W) minibatch tensor, e.g. on the GPU/TPU.
+
+    Arguments:
+        p : (float) probability of flipping each image.
+    """
+
+    def __init__(self, p=0.5):
+        super(BatchRandomHorizontalFlip, self).__init__()
+        self.p = p
+
+    def forward(self, images):
+        flip = torch.rand(images.shape[0], device=images.device) < self.p
+        return torch.where(flip.view(-1, 1, 1, 1), images.flip(3), images)
+
+
+class BatchNormalize(nn.Module):
+    """
+    Converts a (N, C, H, W) minibatch tensor (e.g. of uint8 images) to floating
+    point and normalizes each channel, i.e. (images - mean) / std.
+
+    Arguments:
+        mean  : (list) per channel mean.
+        std   : (list) per channel standard deviation.
+        dtype : (torch.dtype) floating point type of the normalized images.
+    """
+
+    def __init__(self, mean, std, dtype=torch.float32):
+        super(BatchNormalize, self).__init__()
+        self.dtype = dtype
+        self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1))
+
+    def forward(self, images):
+        return images.to(self.dtype).sub_(self.mean).div_(self.std)
+
+
+def split_device_transforms(dataloader_transforms, dtype=torch.float32):
+    """
+    Splits a list of transforms into the transforms applied to each image in the
+    dataloader workers and the transforms applied to each minibatch on the device
+    (GPU or TPU), so that the images can be collated as uint8 tensors (see
+    fast_collate), which are a quarter of the size of float images. The
+    ToTensor and Normalize transforms are replaced by a BatchNormalize, and the
+    RandomHorizontalFlips right before them by BatchRandomHorizontalFlips. The
+    other transforms (e.g. crops, which determine the image size) stay on the CPU.
+
+    Inputs:
+        dataloader_transforms : (list) of transforms ending in ToTensor and,
+                                optionally, Normalize
+        dtype                 : (torch.dtype) floating point type of the
+                                normalized minibatches
+
+    Outputs:
+        cpu_transforms        : (list) of the transforms to apply to each image
+        device_transforms     : (torch.nn.Sequential) of the transforms to apply
+                                to each uint8 minibatch (see wrap_dataloaders)
+    """
+    assert isinstance(dataloader_transforms, list)
+    cpu_transforms = list()
+    mean, std = [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]
+    has_to_tensor = False
+    for t in dataloader_transforms:
+        if isinstance(t, transforms.ToTensor):
+            has_to_tensor = True
+        elif isinstance(t, transforms.Normalize):
+            assert has_to_tensor, "Normalize must come after ToTensor."
+            mean, std = list(t.mean), list(t.std)
+        else:
+            assert not has_to_tensor, "Only Normalize can come after ToTensor."
+            cpu_transforms.append(t)
+    assert has_to_tensor
+
+    device_transforms = list()
+    while (len(cpu_transforms) > 0) and isinstance(
+        cpu_transforms[-1], transforms.RandomHorizontalFlip
+    ):
+        device_transforms.insert(0, BatchRandomHorizontalFlip(cpu_transforms.pop().p))
+
+    # ToTensor scales uint8 images to [0, 1], so we fold it into the normalization
+    mean = [255.0 * m for m in mean]
+    std = [255.0 * s for s in std]
+    device_transforms.append(BatchNormalize(mean=mean, std=std, dtype=dtype))
+    return cpu_transforms, nn.Sequential(*device_transforms)
+
+
 TRAINER_TRANSFORMS = dict()
 TRAINER_TRANSFORMS["SupervisedImageNetTrainer"] = dict()
 TRAINER_TRANSFORMS["SupervisedImageNetTrainer"]["train"] = [
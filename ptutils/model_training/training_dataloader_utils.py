@@ -1,6 +1,95 @@
+import functools
+import hashlib
+import inspect
+import math
+import os
+import random
+import warnings
+
+import numpy as np
+import torch
 from torch.utils import data
+from ptutils.core.default_constants import IMAGENET_MEAN, IMAGENET_STD
 from ptutils.datasets import ImageNetBase
 
+# =======================================================
+# Sampler of the examples for each process
+# =======================================================
+
+
+class CachedDistributedSampler(data.distributed.DistributedSampler):
+    """
+    Same as torch.utils.data.distributed.DistributedSampler, but when the dataset
+    is not shuffled (e.g. the validation set), the indices of this process are
+    the same every epoch, so they are only generated once and then cached.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedDistributedSampler, self).__init__(*args, **kwargs)
+        self._cached_indices = None
+
+    def __iter__(self):
+        if self.shuffle:
+            return super(CachedDistributedSampler, self).__iter__()
+        if self._cached_indices is None:
+            self._cached_indices = list(
+                super(CachedDistributedSampler, self).__iter__()
+            )
+        return iter(self._cached_indices)
+
+
+# =======================================================
+# Initialization of the dataloader workers
+# =======================================================
+
+
+def _parse_cpulist(cpulist):
+    # e.g. "0-15,32-47" -> {0, ..., 15, 32, ..., 47}
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def _gpu_local_cpus(gpu_id):
+    """
+    Returns the set of CPUs on the same NUMA node as the GPU (from sysfs), out of
+    the CPUs this process may run on, or None if they cannot be determined.
+    """
+    try:
+        props = torch.cuda.get_device_properties(gpu_id)
+        pci_address = "{:04x}:{:02x}:{:02x}.0".format(
+            props.pci_domain_id, props.pci_bus_id, props.pci_device_id
+        )
+        with open(f"/sys/bus/pci/devices/{pci_address}/local_cpulist") as f:
+            cpus = _parse_cpulist(f.read())
+        cpus &= os.sched_getaffinity(0)
+    except (AttributeError, OSError, RuntimeError, ValueError):
+        return None
+    return cpus if len(cpus) > 0 else None
+
+
+def _worker_init(worker_id, rank=0, num_workers=1, cpus=None):
+    """
+    Runs in each dataloader worker. The workers of every process are seeded
+    identically by default (if the processes set the same seed), so the seeds are
+    offset by the rank to get different augmentations on each process. numpy and
+    random are seeded too, as they are used by some transforms. If given, the
+    worker is also pinned to cpus, e.g. those local to the GPU of the process.
+    """
+    # torch.initial_seed() is already different for each worker and each epoch
+    seed = torch.initial_seed() + rank * num_workers
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+
 # =======================================================
 # Main function to get dataloader from dataset
 # =======================================================
@@ -16,16 +105,37 @@ def _acquire_dataloader(
     drop_last=False,
     tpu=False,
     collate_fn=None,
+    prefetch_factor=4,
+    pin_memory=None,
+    persistent_workers=True,
+    pin_worker_cpus=True,
 ):
     # Adapted from: https://github.com/pytorch/xla/blob/56138cf7b29dc20ed9b0ca5934b91d1cf9a72b70/test/test_train_mp_imagenet.py#L149
     assert isinstance(dataset, data.Dataset)
-    sampler = data.distributed.DistributedSampler(
+    sampler = CachedDistributedSampler(
         dataset=dataset, num_replicas=world_size, rank=rank, shuffle=train
     )
-    if tpu:
-        loader_kwargs = {"num_workers": num_workers}
-    else:
-        loader_kwargs = {"num_workers": num_workers, "pin_memory": True}
+    if pin_memory is None:
+        # Pinned memory lets the host to GPU copies be asynchronous (see
+        # CUDAPrefetcher), whereas on TPU, MpDeviceLoader does its own transfers
+        pin_memory = not tpu
+    loader_kwargs = {"num_workers": num_workers, "pin_memory": pin_memory}
+    if not tpu:
+        # These can only be set when the examples are loaded by worker processes
+        if num_workers > 0:
+            # Pinning the workers to the CPUs on the NUMA node of the GPU avoids
+            # copying the minibatches across CPU sockets before they reach the GPU
+            cpus = None
+            if pin_worker_cpus and torch.cuda.is_available():
+                cpus = _gpu_local_cpus(torch.cuda.current_device())
+            loader_kwargs["worker_init_fn"] = functools.partial(
+                _worker_init, rank=rank, num_workers=num_workers, cpus=cpus
+            )
+            # Keep the worker processes alive across epochs rather than re-creating
+            # them at the start of every epoch, and have each of them queue up
+            # prefetch_factor minibatches in advance
+            loader_kwargs["persistent_workers"] = persistent_workers
+            loader_kwargs["prefetch_factor"] = prefetch_factor
 
     # shuffle always set to False since we passed it to the sampler already
     loader_kwargs["shuffle"] = False
@@ -44,73 +154,693 @@ def _acquire_dataloader(
         collate_fn=collate_fn,
         **loader_kwargs
     )
+    # The sampler has to be told the epoch at the start of each epoch, so that the
+    # examples are shuffled differently (and identically on every process)
+    loader.set_epoch = sampler.set_epoch
+    return loader
+
+
+# =======================================================
+# Collate minibatches of uint8 images
+# =======================================================
+
+
+def _empty_uint8_batch(shape):
+    if data.get_worker_info() is None:
+        return torch.empty(shape, dtype=torch.uint8)
+
+    # As in default_collate, in a dataloader worker the minibatch is allocated in
+    # shared memory directly, as it is otherwise copied there to be sent to the
+    # main process
+    elem = torch.empty(0, dtype=torch.uint8)
+    numel = int(np.prod(shape))
+    if hasattr(elem, "_typed_storage"):
+        storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+    else:
+        # Before PyTorch 2.0, _new_shared does not take the device (CPU) either
+        storage = elem.storage()._new_shared(numel)
+    return elem.new(storage).resize_(shape)
+
+
+def fast_collate(batch):
+    """
+    Collates a list of (image, label) pairs, where each image is a PIL image or an
+    (H, W, C) uint8 array, into a (N, C, H, W) uint8 tensor and a (N,) int64 tensor.
+    This avoids converting images to float in the dataloader workers, which
+    quadruples the number of bytes copied to the GPU. The conversion to float and
+    normalization is then done on the GPU (see split_device_transforms).
+    Adapted from: https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+    """
+    images = [np.asarray(img, dtype=np.uint8) for img, _ in batch]
+    labels = torch.tensor([label for _, label in batch], dtype=torch.int64)
+    h, w = images[0].shape[:2]
+    num_channels = images[0].shape[2] if images[0].ndim == 3 else 1
+    # Every element is written below, so the minibatch does not need to be zeroed
+    data = _empty_uint8_batch((len(images), num_channels, h, w))
+    for i, img in enumerate(images):
+        if img.ndim < 3:
+            img = np.expand_dims(img, axis=-1)
+        data[i].numpy()[...] = np.rollaxis(img, 2)
+    return data, labels
+
+
+# =======================================================
+# Asynchronous host to GPU transfer of minibatches
+# =======================================================
+
+
+class CUDAPrefetcher(object):
+    """
+    Wraps a dataloader so that the host to GPU copy of the next minibatch is
+    issued on a separate CUDA stream while the current minibatch is being used
+    for computation on the default stream. Like the dataloader, it can be iterated
+    over once per epoch, and it exposes the dataloader's sampler and length.
+    Adapted from: https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+
+    Arguments:
+        loader : (torch.utils.data.DataLoader) dataloader yielding (data, labels)
+                 on the host, ideally from pinned memory.
+        device : (torch.device) GPU device to copy the minibatches to.
+        device_transforms : (torch.nn.Module) optional transforms applied to each
+                            minibatch of data on the GPU, e.g. to convert uint8
+                            data (see fast_collate) to float and normalize it
+                            (see split_device_transforms).
+        channels_last : (boolean) whether to convert data to channels last memory
+                        format, which should match the memory format of the model.
+    """
+
+    def __init__(self, loader, device, device_transforms=None, channels_last=False):
+        self.loader = loader
+        self.device = device
+        self.memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
+        self.stream = torch.cuda.Stream(device=device)
+        self.device_transforms = None
+        if device_transforms is not None:
+            self.device_transforms = device_transforms.to(device)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.loader, "set_epoch"):
+            self.loader.set_epoch(epoch)
+        else:
+            self.loader.sampler.set_epoch(epoch)
+
+    def preload(self):
+        try:
+            self.next_data, self.next_labels = next(self.loader_iter)
+        except StopIteration:
+            self.next_data = None
+            self.next_labels = None
+            return
+
+        # The data and labels are both copied on the side stream, so the current
+        # stream only has to wait on that stream once (see next()). The
+        # copies are only asynchronous if the minibatch is in pinned memory, i.e.
+        # the DataLoader uses pin_memory=True.
+        with torch.cuda.stream(self.stream):
+            self.next_data = self.next_data.to(
+                self.device, non_blocking=True, memory_format=self.memory_format
+            )
+            if self.device_transforms is not None:
+                self.next_data = self.device_transforms(self.next_data)
+            self.next_labels = self.next_labels.to(self.device, non_blocking=True)
+
+    def next(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        data = self.next_data
+        labels = self.next_labels
+        # The tensors were allocated on the side stream, so make sure their memory
+        # is not reused before the computation on the current stream is done
+        if data is not None:
+            data.record_stream(torch.cuda.current_stream())
+        if labels is not None:
+            labels.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return data, labels
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        data, labels = self.next()
+        while data is not None:
+            yield data, labels
+            data, labels = self.next()
+
+
+class XLADeviceLoader(object):
+    """
+    Wraps a torch_xla MpDeviceLoader, which transfers the minibatches to the TPU,
+    to apply transforms to each minibatch of data once it is on the TPU (e.g. to
+    convert uint8 data to float and normalize it, see split_device_transforms).
+    Like MpDeviceLoader, the underlying dataloader is accessible as _loader.
+
+    Arguments:
+        device_loader     : (MpDeviceLoader) loader of the minibatches.
+        device            : (torch.device) TPU device of the minibatches.
+        device_transforms : (torch.nn.Module) optional transforms applied to each
+                            minibatch of data.
+    """
+
+    def __init__(self, device_loader, device, device_transforms=None):
+        self.device_loader = device_loader
+        self._loader = device_loader._loader
+        self.device_transforms = None
+        if device_transforms is not None:
+            self.device_transforms = device_transforms.to(device)
+
+    def __len__(self):
+        return len(self.device_loader)
+
+    def __iter__(self):
+        for data, labels in self.device_loader:
+            if self.device_transforms is not None:
+                data = self.device_transforms(data)
+            yield data, labels
+
+
+def _wrap_for_device(
+    loader, device, device_transforms=None, channels_last=False, tpu_loader_kwargs=None
+):
+    """
+    Wraps a dataloader so that it yields minibatches on the device: in a
+    MpDeviceLoader (and XLADeviceLoader) on TPU, which is given tpu_loader_kwargs
+    (e.g. loader_prefetch_size), and in a CUDAPrefetcher on GPU.
+    Loaders that are None, already wrapped or that are not torch DataLoaders
+    (e.g. DALI dataloaders, which already yield minibatches on the GPU) are
+    returned as is.
+    """
+    if not isinstance(loader, data.DataLoader):
+        return loader
+
+    if device.type == "xla":
+        import torch_xla.distributed.parallel_loader as pl
+
+        if tpu_loader_kwargs is None:
+            tpu_loader_kwargs = dict()
+        return XLADeviceLoader(
+            pl.MpDeviceLoader(loader=loader, device=device, **tpu_loader_kwargs),
+            device,
+            device_transforms=device_transforms,
+        )
+    elif device.type == "cuda":
+        # Copy the next minibatch to the GPU while computing on the current one
+        return CUDAPrefetcher(
+            loader,
+            device,
+            device_transforms=device_transforms,
+            channels_last=channels_last,
+        )
     return loader
 
 
+def _per_process_batch_size(batch_size, world_size, name="batch_size"):
+    """
+    Returns the batch size of each process. If the (total) batch size is not a
+    multiple of the number of processes, it is rounded up to the next multiple.
+    """
+    per_process_batch_size = math.ceil(batch_size / world_size)
+    if per_process_batch_size * world_size != batch_size:
+        warnings.warn(
+            f"{name} {batch_size} is not a multiple of the number of processes "
+            f"({world_size}), so it is rounded up to "
+            f"{per_process_batch_size * world_size}."
+        )
+    return per_process_batch_size
+
+
 # =======================================================
 # Wrapper for getting dataloaders
 # =======================================================
 def wrap_dataloaders(
-    dataloader_func, params, my_transforms, device, rank=0, world_size=1
+    dataloader_func,
+    params,
+    my_transforms,
+    device,
+    rank=0,
+    world_size=1,
+    device_transforms=None,
+    channels_last=False,
 ):
+    """
+    Inputs:
+        dataloader_func     : (function) returns the train and val dataloaders
+                              given params and my_transforms (e.g.
+                              get_imagenet_loaders).
+        params              : (dict) dataloader parameters.
+        my_transforms       : (dict) image transforms for "train" and "val".
+        device              : (torch.device) device the minibatches are used on.
+        rank                : (int) rank of the current process.
+        world_size          : (int) number of processes.
+        device_transforms   : (dict) optional transforms for "train" and "val"
+                              applied to each minibatch once it is on the device
+                              (see split_device_transforms).
+        channels_last       : (boolean) whether GPU minibatches are converted to
+                              channels last memory format.
+
+    Outputs:
+        train_loader        : the train dataloader, which copies minibatches to
+                              the device (None if there are no train transforms).
+        val_loader          : the val dataloader, which copies minibatches to
+                              the device.
+    """
     tpu = device.type == "xla"
+    if device_transforms is None:
+        device_transforms = {"train": None, "val": None}
+
+    # Number of minibatches queued on the host and on the TPU by MpDeviceLoader,
+    # which can be tuned for the TPU host (torch_xla's defaults are used otherwise)
+    tpu_loader_kwargs = dict()
+    if "tpu_loader_prefetch" in params:
+        tpu_loader_kwargs["loader_prefetch_size"] = params["tpu_loader_prefetch"]
+    if "tpu_device_prefetch" in params:
+        tpu_loader_kwargs["device_prefetch_size"] = params["tpu_device_prefetch"]
 
-    assert params["train_batch_size"] % world_size == 0
-    if "val_batch_size" in params.keys():
-        assert params["val_batch_size"] % world_size == 0
-    # for TPU and GPU we do multiprocessing, so batch size is per GPU/TPU core
-    params["train_batch_size"] = params["train_batch_size"] // world_size
-    if "val_batch_size" in params.keys():
-        params["val_batch_size"] = params["val_batch_size"] // world_size
+    # for TPU and GPU we do multiprocessing, so batch size is per GPU/TPU core.
+    # The per process batch sizes are put in a copy of params, so that params can
+    # be reused (e.g. by calling this function again).
+    local_params = dict(params)
+    for key in ["train_batch_size", "val_batch_size"]:
+        if key in params:
+            local_params[key] = _per_process_batch_size(
+                params[key], world_size, name=key
+            )
 
     train_loader, val_loader = dataloader_func(
-        params=params,
+        params=local_params,
         my_transforms=my_transforms,
         rank=rank,
         world_size=world_size,
         tpu=tpu,
     )
 
-    if tpu:
-        import torch_xla.distributed.parallel_loader as pl
+    train_loader = _wrap_for_device(
+        train_loader,
+        device,
+        device_transforms=device_transforms["train"],
+        channels_last=channels_last,
+        tpu_loader_kwargs=tpu_loader_kwargs,
+    )
+    val_loader = _wrap_for_device(
+        val_loader,
+        device,
+        device_transforms=device_transforms["val"],
+        channels_last=channels_last,
+        tpu_loader_kwargs=tpu_loader_kwargs,
+    )
+
+    return train_loader, val_loader
+
 
-        train_loader = pl.MpDeviceLoader(loader=train_loader, device=device)
-        if val_loader is not None:
-            val_loader = pl.MpDeviceLoader(loader=val_loader, device=device)
+def _check_jpeg_decoder():
+    """
+    Warns if Pillow was not built with libjpeg-turbo, whose SIMD decoder is much
+    faster than the stock libjpeg one. JPEG decoding in the dataloader workers is
+    usually the main CPU cost of loading ImageNet.
+    """
+    try:
+        from PIL import features
 
+        has_libjpeg_turbo = features.check_feature("libjpeg_turbo")
+    except (ImportError, ValueError):
+        # Older versions of Pillow cannot report it
+        return
+
+    if not has_libjpeg_turbo:
+        warnings.warn(
+            "Pillow was not built with libjpeg-turbo, so decoding JPEGs will be "
+            "slow. Consider installing pillow-simd (pip install ptutils[simd])."
+        )
+
+
+# =======================================================
+# Memory mapped validation set
+# =======================================================
+
+
+class MmapImageDataset(data.Dataset):
+    """
+    Data set of (H, W, C) uint8 images and their labels, stored in .npy files
+    (see _materialize_val_mmap) that are memory mapped, so that the images do not
+    have to be decoded and transformed again. The images file is only opened when
+    the first image is read, so that it is opened (rather than pickled) by each
+    dataloader worker.
+
+    Arguments:
+        images_file : (string) .npy file of the (N, H, W, C) uint8 images.
+        labels_file : (string) .npy file of the (N,) int64 labels.
+    """
+
+    def __init__(self, images_file, labels_file):
+        super(MmapImageDataset, self).__init__()
+        self.images_file = images_file
+        self.images = None
+        self.labels = np.load(labels_file)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.load(self.images_file, mmap_mode="r")
+        return self.images[index], int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def _stack_examples(batch):
+    images = np.stack([np.asarray(img) for img, _ in batch])
+    assert images.dtype == np.uint8, "Images must be uint8, e.g. PIL images."
+    labels = np.array([label for _, label in batch], dtype=np.int64)
+    return images, labels
+
+
+def _materialize_val_mmap(val_set, images_file, labels_file, num_workers):
+    """
+    Writes the (transformed) images and labels of val_set to .npy files. The
+    transforms have to be deterministic and produce images of the same size.
+    """
+    loader = data.DataLoader(
+        val_set, batch_size=256, num_workers=num_workers, collate_fn=_stack_examples
+    )
+    images = None
+    labels = np.empty(len(val_set), dtype=np.int64)
+    # Write to temporary files first so that other processes never read a
+    # partially written validation set
+    tmp_images_file = f"{images_file}.{os.getpid()}.tmp"
+    tmp_labels_file = f"{labels_file}.{os.getpid()}.tmp"
+    start = 0
+    for batch_images, batch_labels in loader:
+        if images is None:
+            images = np.lib.format.open_memmap(
+                tmp_images_file,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(val_set),) + batch_images.shape[1:],
+            )
+        end = start + len(batch_labels)
+        images[start:end] = batch_images
+        labels[start:end] = batch_labels
+        start = end
+    assert start == len(val_set)
+    images.flush()
+    del images
+
+    with open(tmp_labels_file, "wb") as f:
+        np.save(f, labels)
+    os.replace(tmp_labels_file, labels_file)
+    os.replace(tmp_images_file, images_file)
+
+
+def _get_val_mmap_dataset(
+    val_set, val_transforms, imagenet_dir, mmap_dir, rank=0, num_workers=0
+):
+    """
+    Returns a MmapImageDataset of val_set, which is written to mmap_dir by rank 0
+    if it does not exist yet (in that case, the other ranks use val_set as is).
+    The file names contain a hash of the class of val_set, imagenet_dir and the
+    repr of val_transforms, so that the validation set is written again (rather
+    than reused) when any of them change.
+    """
+    key = "\n".join(
+        [
+            type(val_set).__name__,
+            os.path.abspath(imagenet_dir),
+            repr(val_transforms),
+        ]
+    )
+    key_hash = hashlib.sha1(key.encode()).hexdigest()[:12]
+    images_file = os.path.join(mmap_dir, f"val_images_{key_hash}.npy")
+    labels_file = os.path.join(mmap_dir, f"val_labels_{key_hash}.npy")
+    if not os.path.isfile(images_file):
+        if rank != 0:
+            return val_set
+        os.makedirs(mmap_dir, exist_ok=True)
+        _materialize_val_mmap(
+            val_set,
+            images_file=images_file,
+            labels_file=labels_file,
+            num_workers=num_workers,
+        )
+
+    mmap_set = MmapImageDataset(images_file=images_file, labels_file=labels_file)
+    assert len(mmap_set) == len(val_set)
+    return mmap_set
+
+
+class SharedMemoryCache(data.Dataset):
+    """
+    Caches the (H, W, C) uint8 images of a data set with deterministic transforms
+    (e.g. the validation set) in shared memory, so that each image is only decoded
+    and transformed once, and the dataloader workers all share a single copy of
+    the cache rather than each having their own. The cache is filled by the
+    workers as the images are first read.
+
+    The examples that are cached are fixed: the first ones (in the order given by
+    indices) that fit in the cache. Since every epoch reads all of the examples in
+    the same order, evicting examples (e.g. least recently used) would only
+    replace cached examples by ones that are not read again until the next epoch.
+
+    Arguments:
+        dataset  : (torch.utils.data.Dataset) data set of (image, label) pairs,
+                   where the images are uint8 (H, W[, C]) arrays or PIL images of
+                   one size (float tensors, e.g. from ToTensor(), are rejected).
+        cache_gb : (float) size of the cache in GB.
+        indices  : (list) optional indices of the examples to cache, in order of
+                   priority, e.g. those read by the current process.
+    """
+
+    def __init__(self, dataset, cache_gb, indices=None):
+        super(SharedMemoryCache, self).__init__()
+        self.dataset = dataset
+        if indices is None:
+            indices = range(len(dataset))
+
+        image = np.asarray(dataset[indices[0]][0])
+        assert (image.dtype == np.uint8) and (
+            image.ndim in (2, 3)
+        ), "Images must be uint8 (H, W[, C]) arrays, e.g. PIL images."
+        image_shape = image.shape
+        image_bytes = int(np.prod(image_shape))
+        num_slots = min(len(indices), int(cache_gb * (1024 ** 3)) // image_bytes)
+        indices = torch.as_tensor(indices[:num_slots], dtype=torch.int64)
+
+        # Slot of each example in the cache (-1 if it is not cached), whether each
+        # slot has been filled, and the images (one contiguous buffer)
+        self.slots = torch.full((len(dataset),), -1, dtype=torch.int64)
+        self.slots[indices] = torch.arange(num_slots)
+        self.filled = torch.zeros(num_slots, dtype=torch.bool).share_memory_()
+        self.images = torch.empty(
+            (num_slots,) + image_shape, dtype=torch.uint8
+        ).share_memory_()
+        self.labels = torch.empty(num_slots, dtype=torch.int64).share_memory_()
+
+    def __getitem__(self, index):
+        slot = int(self.slots[index])
+        if slot < 0:
+            return self.dataset[index]
+        if not self.filled[slot]:
+            image, label = self.dataset[index]
+            image = np.asarray(image)
+            assert image.dtype == np.uint8
+            self.images[slot].numpy()[...] = image
+            self.labels[slot] = label
+            self.filled[slot] = True
+        return self.images[slot].numpy(), int(self.labels[slot])
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+# =======================================================
+# NVIDIA DALI dataloaders
+# =======================================================
+
+
+class DALILoader(object):
+    """
+    Wraps a DALIClassificationIterator so that, like the other GPU dataloaders
+    (see CUDAPrefetcher), it yields (data, labels) minibatches on the GPU, with
+    int64 labels of shape (N,), and has a length and a set_epoch method.
+
+    Arguments:
+        iterator : (DALIClassificationIterator) iterator over the DALI pipeline,
+                   which is reset at the end of every epoch.
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+    def set_epoch(self, epoch):
+        # The DALI reader reshuffles the examples every epoch by itself
+        pass
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield batch[0]["data"], batch[0]["label"].view(-1).long()
+
+
+def _get_dali_loaders(params, my_transforms, rank=0, world_size=1):
+    """
+    Builds ImageNet dataloaders with NVIDIA DALI, where the JPEGs are decoded
+    (with nvJPEG) and augmented on the GPU. The augmentations are fixed to the
+    standard ImageNet ones: random resized crop and horizontal flip for training,
+    and resize and center crop for validation, followed by normalization with the
+    ImageNet mean and standard deviation. As such, my_transforms is only used to
+    determine whether to build the train dataloader (i.e. it is not None).
+    """
+    from nvidia.dali import fn, pipeline_def, types
+    from nvidia.dali.plugin.pytorch import (
+        DALIClassificationIterator,
+        LastBatchPolicy,
+    )
+
+    crop_size = params.get("image_size", 224)
+    resize_size = params.get("val_resize_size", 256)
+    device_id = params.get("device_id", torch.cuda.current_device())
+    num_threads = max(params["num_workers"], 1)
+    drop_last = params.get("drop_last", False)
+
+    @pipeline_def
+    def imagenet_pipeline(is_train):
+        suffix = "train" if is_train else "val"
+        jpegs, labels = fn.readers.file(
+            file_root=os.path.join(params["image_dir"], suffix),
+            shard_id=rank,
+            num_shards=world_size,
+            random_shuffle=is_train,
+            pad_last_batch=True,
+            name="Reader",
+        )
+        if is_train:
+            images = fn.decoders.image_random_crop(
+                jpegs, device="mixed", output_type=types.RGB
+            )
+            images = fn.resize(images, resize_x=crop_size, resize_y=crop_size)
+            mirror = fn.random.coin_flip(probability=0.5)
+        else:
+            images = fn.decoders.image(jpegs, device="mixed", output_type=types.RGB)
+            images = fn.resize(images, resize_shorter=resize_size)
+            mirror = False
+        images = fn.crop_mirror_normalize(
+            images,
+            dtype=types.FLOAT,
+            output_layout="CHW",
+            crop=(crop_size, crop_size),
+            mean=[255.0 * m for m in IMAGENET_MEAN],
+            std=[255.0 * s for s in IMAGENET_STD],
+            mirror=mirror,
+        )
+        return images, labels.gpu()
+
+    def build_loader(is_train, batch_size):
+        pipeline = imagenet_pipeline(
+            is_train=is_train,
+            batch_size=batch_size,
+            num_threads=num_threads,
+            device_id=device_id,
+            seed=params.get("seed", 0) + rank,
+        )
+        pipeline.build()
+        iterator = DALIClassificationIterator(
+            pipeline,
+            reader_name="Reader",
+            last_batch_policy=(
+                LastBatchPolicy.DROP if drop_last else LastBatchPolicy.PARTIAL
+            ),
+            auto_reset=True,
+        )
+        return DALILoader(iterator)
+
+    train_loader = None
+    if my_transforms["train"] is not None:
+        train_loader = build_loader(True, params["train_batch_size"])
+    val_loader = build_loader(False, params["val_batch_size"])
     return train_loader, val_loader
 
 
+def _accepts_kwargs(func, names):
+    # Whether func (e.g. a class) can be called with all of the keyword arguments
+    parameters = inspect.signature(func).parameters.values()
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters):
+        return True
+    return set(names).issubset(p.name for p in parameters)
+
+
 def get_imagenet_loaders(params, my_transforms, rank=0, world_size=1, tpu=False):
     # Assumes image_dir organization is /PATH/TO/IMAGENET/{train, val}/{synsets}/*.JPEG
-    assert "image_dir" in params.keys()
-    assert "dataset_class" in params.keys()
-    assert "train_batch_size" in params.keys()
-    assert "val_batch_size" in params.keys()
-    assert "num_workers" in params.keys()
-    assert "train" in my_transforms.keys()
-    assert "val" in my_transforms.keys()
+    # These checks (like all asserts) are skipped when running python -O
+    if __debug__:
+        for key in [
+            "image_dir",
+            "dataset_class",
+            "train_batch_size",
+            "val_batch_size",
+            "num_workers",
+        ]:
+            assert key in params, f"{key} is missing from params."
+        for split in ["train", "val"]:
+            assert split in my_transforms, f"{split} is missing from my_transforms."
+
+    loader_backend = params.get("loader_backend", "torch")
+    assert loader_backend in ["torch", "dali"]
+    if loader_backend == "dali":
+        assert not tpu, "DALI dataloaders are GPU only."
+        return _get_dali_loaders(
+            params=params, my_transforms=my_transforms, rank=rank, world_size=world_size
+        )
+
+    _check_jpeg_decoder()
 
     train_batch_size = params["train_batch_size"]
     val_batch_size = params["val_batch_size"]
     num_workers = params["num_workers"]
+    collate_fn = params.get("collate_fn", None)
+    prefetch_factor = params.get("prefetch_factor", 4)
+    pin_memory = params.get("pin_memory", not tpu)
+    persistent_workers = params.get("persistent_workers", True)
+    pin_worker_cpus = params.get("pin_worker_cpus", True)
     drop_last = params.get("drop_last", False)
     dataset_class = params["dataset_class"]
     assert issubclass(dataset_class, ImageNetBase)
     imagenet_dir = params["image_dir"]
+    # Optionally, the image paths and labels are cached in an index file in
+    # index_dir, written by rank 0, so that the image directory is only scanned
+    # once. Subclasses of ImageNetBase whose constructor does not take the index
+    # arguments are constructed without them.
+    dataset_kwargs = dict()
+    index_dir = params.get("index_dir", None)
+    if index_dir is not None:
+        if _accepts_kwargs(dataset_class, ["index_dir", "write_index"]):
+            dataset_kwargs = {"index_dir": index_dir, "write_index": (rank == 0)}
+        else:
+            warnings.warn(
+                f"{dataset_class.__name__} does not take index_dir and "
+                "write_index, so the image index is not cached."
+            )
     train_transforms = my_transforms["train"]
     val_transforms = my_transforms["val"]
 
+    # Eval only runs (no train transforms) do not touch the train set at all
     if train_transforms is not None:
         train_set = dataset_class(
-            is_train=True, imagenet_dir=imagenet_dir, image_transforms=train_transforms,
+            is_train=True,
+            imagenet_dir=imagenet_dir,
+            image_transforms=train_transforms,
+            **dataset_kwargs,
         )
-
-    val_set = dataset_class(
-        is_train=False, imagenet_dir=imagenet_dir, image_transforms=val_transforms
-    )
-
-    if train_transforms is not None:
         train_loader = _acquire_dataloader(
             dataset=train_set,
             train=True,
@@ -120,10 +850,45 @@ def get_imagenet_loaders(params, my_transforms, rank=0, world_size=1, tpu=False)
             world_size=world_size,
             drop_last=drop_last,
             tpu=tpu,
+            prefetch_factor=prefetch_factor,
+            collate_fn=collate_fn,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            pin_worker_cpus=pin_worker_cpus,
         )
     else:
         train_loader = None
 
+    val_set = dataset_class(
+        is_train=False,
+        imagenet_dir=imagenet_dir,
+        image_transforms=val_transforms,
+        **dataset_kwargs,
+    )
+    # The validation images are the same every epoch, so they can be decoded and
+    # transformed once and stored in a memory mapped file
+    val_mmap_dir = params.get("val_mmap_dir", None)
+    if val_mmap_dir is not None:
+        val_set = _get_val_mmap_dataset(
+            val_set,
+            val_transforms,
+            imagenet_dir,
+            val_mmap_dir,
+            rank=rank,
+            num_workers=num_workers,
+        )
+    # Alternatively, the decoded validation images can be cached in shared memory.
+    # The examples of this process are cached first (see CachedDistributedSampler).
+    shm_cache_gb = params.get("shm_cache_gb", 0)
+    if (shm_cache_gb > 0) and (not isinstance(val_set, MmapImageDataset)):
+        num_examples = len(val_set)
+        total_size = math.ceil(num_examples / world_size) * world_size
+        val_set = SharedMemoryCache(
+            val_set,
+            cache_gb=shm_cache_gb,
+            indices=[i % num_examples for i in range(rank, total_size, world_size)],
+        )
+
     val_loader = _acquire_dataloader(
         dataset=val_set,
         train=False,
@@ -133,6 +898,11 @@ def get_imagenet_loaders(params, my_transforms, rank=0, world_size=1, tpu=False)
         world_size=world_size,
         drop_last=drop_last,
         tpu=tpu,
+        prefetch_factor=prefetch_factor,
+        collate_fn=collate_fn,
+        pin_memory=pin_memory,
+        persistent_workers=persistent_workers,
+        pin_worker_cpus=pin_worker_cpus,
     )
 
     return train_loader, val_loader
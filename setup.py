@@ -1,23 +1,33 @@
 from setuptools import setup, find_packages
 import os
 
+# Only the packages imported by the training code (e.g. by the dataloader
+# workers) are required. Other utilities' dependencies are in the extras.
+extras_require = {
+    # Pillow-SIMD is a drop-in replacement for Pillow with faster JPEG decoding
+    # and resizing (pip uninstall pillow before installing it)
+    "simd": ["pillow-simd"],
+    "full": [
+        "scikit-learn>=0.24.2",
+        "scipy>=1.7.1",
+        "pandas>=1.3.4",
+        "google-cloud-storage",
+    ],
+    "dev": ["black>=19.10b0"],
+}
+
 if os.path.exists("requirements.txt"):
     with open("requirements.txt", "r") as fb:
         requirements = fb.readlines()
 else:
     requirements = [
-        "torch>=1.9",
-        "torchvision>=0.10.0",
+        "torch>=1.10",
+        "torchvision>=0.11.0",
         "numpy>=1.20.3",
-        "scikit-learn>=0.24.2",
-        "scipy>=1.7.1",
-        "pandas>=1.3.4",
-        "black>=19.10b0",
         "pymongo>=3.11.1",
         "jsonpickle>=1.4.1",
         "shapely>=1.7.1",
         "regex",
-        "google-cloud-storage",
     ]
 
 print(find_packages())
@@ -26,6 +36,7 @@ setup(
     version="0.1",
     packages=find_packages(),
     install_requires=requirements,
+    extras_require=extras_require,
     python_requires=">=3.6",
     # metadata to display on PyPI
     description="Pytorch utilities for model training on GPU and TPU",